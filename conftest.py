@@ -0,0 +1,14 @@
+# Root conftest: makes pytest put the repository root on sys.path so tests can `import main`.
+import pytest
+
+import main
+
+
+@pytest.fixture
+def make_order():
+    """Returns a factory for pending CityA → CityB orders placed by customer 1001 through the clone bot."""
+    def factory(order_id: str = "0123456789abcdef") -> main.Order:
+        return main.Order(id=order_id, from_location="CityA", to_location="CityB", phone="+1234567890",
+                          luggage="No", time="Now", comment="", passengers=1,
+                          clone_bot_token="43:CLONE", customer_chat_id=1001, customer_message_id=7)
+    return factory
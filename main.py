@@ -1,17 +1,25 @@
 import asyncio
 import logging
 import json
+import re
+import sys
 import uuid
+from collections import OrderedDict
+from itertools import islice
 from dataclasses import dataclass, field
-from typing import Dict, Optional, List, Set, Any
+from functools import partial
+from typing import Dict, Optional, List, Set, FrozenSet, Any, Tuple
 
+from aiolimiter import AsyncLimiter
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import CommandStart, Command, StateFilter, BaseFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, TelegramObject
 
 # --- Configuration ---
 class Config:
@@ -26,12 +34,15 @@ class Config:
     # then forward a message from the group to @userinfobot to get its ID (starts with -100).
     MAIN_GROUP_ID: int = -1002553104013
 
+    # Maximum number of orders kept in memory. Beyond this, the oldest finished (non-pending) orders are dropped.
+    MAX_STORED_ORDERS: int = 10000
+
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Data Models ---
-@dataclass
+@dataclass(slots=True)
 class Order:
     """Represents a single taxi order."""
     id: str
@@ -42,14 +53,16 @@ class Order:
     time: str      # e.g., "Now", "14:30", "Tomorrow morning"
     comment: str   # Any additional comments
     passengers: int
+    clone_bot_token: str  # Token of the bot that received the order
+    customer_chat_id: int # Chat ID of the customer who placed the order
     status: str = "pending"  # pending, accepted, rejected, completed
     driver_id: Optional[int] = None
     driver_username: Optional[str] = None
-    clone_bot_token: str  # Token of the bot that received the order
-    customer_chat_id: int # Chat ID of the customer who placed the order
     customer_message_id: Optional[int] = None # Message ID of the order confirmation for customer
+    group_message_text: Optional[str] = None # HTML text of the order message posted to the group
+    target_thread_id: Optional[int] = None # Topic ID of the order's route, resolved once when the order is created
 
-@dataclass
+@dataclass(slots=True)
 class BotInstance:
     """Represents a registered bot (main or clone)."""
     token: str
@@ -57,12 +70,30 @@ class BotInstance:
     is_main: bool = False
     active: bool = True
 
-@dataclass
+@dataclass(slots=True)
 class Route:
     """Represents a taxi route and its linked Telegram topic."""
     name: str
     thread_id: Optional[int] = None # Topic ID in the main group
 
+RouteKey = Tuple[str, str] # (from_location, to_location)
+
+def parse_route_name(name: str) -> Optional[RouteKey]:
+    """Splits a route name like 'CityA → CityB' or 'CityA-CityB' into its (from, to) lookup key."""
+    for separator in ("→", "->"):
+        from_location, found, to_location = name.partition(separator)
+        if found:
+            break
+    else:
+        # A plain '-' is only unambiguous when there is exactly one; hyphenated city names must use '→' or '->'
+        if name.count("-") != 1:
+            return None
+        from_location, _, to_location = name.partition("-")
+    from_location, to_location = from_location.strip(), to_location.strip()
+    if not from_location or not to_location:
+        return None
+    return from_location, to_location
+
 # --- In-Memory Storage ---
 class InMemoryStorage:
     """
@@ -71,9 +102,13 @@ class InMemoryStorage:
     """
     def __init__(self):
         self.bot_instances: Dict[str, BotInstance] = {} # Maps token to BotInstance
-        self.routes: Dict[str, Route] = {}             # Maps route_name to Route
-        self.orders: Dict[str, Order] = {}             # Maps order_id to Order
-        self.admin_users: Set[int] = set(Config.ADMIN_USER_IDS)
+        self.routes: Dict[RouteKey, Route] = {}        # Maps (from_location, to_location) to Route
+        self.orders: OrderedDict[str, Order] = OrderedDict() # Maps order_id to Order, finished orders last
+        self.pending_order_ids: Dict[str, None] = {}   # Index of orders whose status is 'pending', in creation order
+        self.admin_users: FrozenSet[int] = frozenset(Config.ADMIN_USER_IDS)
+        # Immutable copies of the bot/route values, rebuilt on (rare) admin writes and handed out as-is to readers
+        self._bots_snapshot: Tuple[BotInstance, ...] = ()
+        self._routes_snapshot: Tuple[Route, ...] = ()
 
         # Add the main bot to storage upon initialization
         self.add_bot_instance(BotInstance(token=Config.MAIN_BOT_TOKEN, name="Main Bot", is_main=True))
@@ -82,45 +117,56 @@ class InMemoryStorage:
     def add_bot_instance(self, bot_instance: BotInstance):
         """Adds or updates a bot instance in storage."""
         self.bot_instances[bot_instance.token] = bot_instance
-        logger.info(f"Bot instance '{bot_instance.name}' added/updated in storage.")
+        self._bots_snapshot = tuple(self.bot_instances.values())
+        logger.info("Bot instance '%s' added/updated in storage.", bot_instance.name)
 
     def get_bot_instance(self, token: str) -> Optional[BotInstance]:
         """Retrieves a bot instance by its token."""
         return self.bot_instances.get(token)
 
-    def get_all_bot_instances(self) -> List[BotInstance]:
-        """Returns a list of all registered bot instances."""
-        return list(self.bot_instances.values())
+    def get_all_bot_instances(self) -> Tuple[BotInstance, ...]:
+        """Returns all registered bot instances as a shared, immutable snapshot."""
+        return self._bots_snapshot
 
     def delete_bot_instance(self, token: str):
         """Deletes a bot instance by its token."""
         if token in self.bot_instances:
             del self.bot_instances[token]
-            logger.info(f"Bot instance with token '{token}' deleted from storage.")
-
-    def add_route(self, route: Route):
-        """Adds a new route to storage."""
-        self.routes[route.name] = route
-        logger.info(f"Route '{route.name}' added to storage.")
-
-    def get_route(self, name: str) -> Optional[Route]:
-        """Retrieves a route by its name."""
-        return self.routes.get(name)
-
-    def get_all_routes(self) -> List[Route]:
-        """Returns a list of all registered routes."""
-        return list(self.routes.values())
-
-    def delete_route(self, name: str):
-        """Deletes a route by its name."""
-        if name in self.routes:
-            del self.routes[name]
-            logger.info(f"Route '{name}' deleted from storage.")
+            self._bots_snapshot = tuple(self.bot_instances.values())
+            logger.info("Bot instance with token '%s' deleted from storage.", token)
+
+    def add_route(self, key: RouteKey, route: Route):
+        """Adds a new route to storage under its (from, to) key."""
+        self.routes[key] = route
+        self._routes_snapshot = tuple(self.routes.values())
+        logger.info("Route '%s' added to storage.", route.name)
+
+    def get_route(self, key: RouteKey) -> Optional[Route]:
+        """Retrieves a route by its (from, to) key."""
+        return self.routes.get(key)
+
+    def get_all_routes(self) -> Tuple[Route, ...]:
+        """Returns all registered routes as a shared, immutable snapshot."""
+        return self._routes_snapshot
+
+    def delete_route(self, key: RouteKey):
+        """Deletes a route by its (from, to) key."""
+        if key in self.routes:
+            route = self.routes.pop(key)
+            self._routes_snapshot = tuple(self.routes.values())
+            logger.info("Route '%s' deleted from storage.", route.name)
 
     def add_order(self, order: Order):
         """Adds a new order to storage."""
+        # Many orders share the same locations/luggage/time values; intern them so equal strings share one object
+        order.from_location = sys.intern(order.from_location)
+        order.to_location = sys.intern(order.to_location)
+        order.luggage = sys.intern(order.luggage)
+        order.time = sys.intern(order.time)
         self.orders[order.id] = order
-        logger.info(f"Order '{order.id}' added to storage.")
+        if order.status == "pending":
+            self.pending_order_ids[order.id] = None
+        logger.info("Order '%s' added to storage.", order.id)
 
     def get_order(self, order_id: str) -> Optional[Order]:
         """Retrieves an order by its ID."""
@@ -129,30 +175,59 @@ class InMemoryStorage:
     def update_order(self, order: Order):
         """Updates an existing order in storage."""
         self.orders[order.id] = order
-        logger.info(f"Order '{order.id}' updated in storage.")
+        # Keep the pending index in sync with status transitions
+        if order.status == "pending":
+            self.pending_order_ids[order.id] = None
+        else:
+            self.pending_order_ids.pop(order.id, None)
+            self.orders.move_to_end(order.id)
+            self._prune_orders()
+        logger.info("Order '%s' updated in storage.", order.id)
+
+    def _prune_orders(self):
+        """Drops the oldest finished orders while more than Config.MAX_STORED_ORDERS are stored."""
+        # Never ask for more than the finished orders that exist, so the scan stops at the last one
+        # (and doesn't run at all when pending orders alone fill the store)
+        finished_count = len(self.orders) - len(self.pending_order_ids)
+        excess = min(len(self.orders) - Config.MAX_STORED_ORDERS, finished_count)
+        if excess <= 0:
+            return
+        finished = (order_id for order_id in self.orders if order_id not in self.pending_order_ids)
+        stale_ids = list(islice(finished, excess))
+        for order_id in stale_ids:
+            del self.orders[order_id]
+        if stale_ids:
+            logger.info("Pruned %d finished order(s) from storage.", len(stale_ids))
 
     def get_pending_orders(self) -> List[Order]:
-        """Returns a list of all orders with 'pending' status."""
-        return [order for order in self.orders.values() if order.status == "pending"]
+        """Returns a list of all orders with 'pending' status in creation order, read from the pending index."""
+        return [self.orders[order_id] for order_id in self.pending_order_ids]
 
 # --- Custom Filters ---
 class IsAdmin(BaseFilter):
     """Filter to check if the message sender is an admin."""
     def __init__(self, storage: InMemoryStorage):
-        self.storage = storage
+        self.admin_users = storage.admin_users
 
     async def __call__(self, message: Message) -> bool:
-        return message.from_user.id in self.storage.admin_users
+        return message.from_user.id in self.admin_users
 
 class IsMainBot(BaseFilter):
-    """Filter to check if the update came from the main bot's token."""
-    async def __call__(self, bot: Bot) -> bool:
-        return bot.token == Config.MAIN_BOT_TOKEN
+    """Filter to check if the update came from the main bot."""
+    def __init__(self, main_bot: Bot):
+        self.main_bot = main_bot
+
+    async def __call__(self, event: TelegramObject, bot: Bot) -> bool:
+        # The Dispatcher passes the same Bot object it polls with, so an identity check replaces the token compare
+        return bot is self.main_bot
 
 class IsCloneBot(BaseFilter):
-    """Filter to check if the update came from a clone bot's token."""
-    async def __call__(self, bot: Bot) -> bool:
-        return bot.token != Config.MAIN_BOT_TOKEN
+    """Filter to check if the update came from a clone bot."""
+    def __init__(self, main_bot: Bot):
+        self.main_bot = main_bot
+
+    async def __call__(self, event: TelegramObject, bot: Bot) -> bool:
+        return bot is not self.main_bot
 
 # --- FSM for Client Ordering (Clone Bots) ---
 class OrderStates(StatesGroup):
@@ -167,30 +242,27 @@ class OrderStates(StatesGroup):
     confirm_order = State()
 
 # --- Main Bot Handlers (Admin Panel & Order Distribution) ---
-async def admin_start(message: Message, bot: Bot, storage: InMemoryStorage):
+_ADMIN_HELP_HTML = (
+    "<b>Admin Panel</b>\n\n"
+    "<b>Clone Bots:</b>\n"
+    "/add_clone_bot &lt;token&gt; &lt;name&gt; - Add a new clone bot token\n"
+    "/list_clone_bots - List all registered clone bots\n"
+    "/delete_clone_bot &lt;token&gt; - Delete a clone bot\n\n"
+    "<b>Routes:</b>\n"
+    "/add_route &lt;name&gt; - Add a new route (e.g., CityA-CityB)\n"
+    "/list_routes - List all routes\n"
+    "/link_route &lt;name&gt; &lt;thread_id&gt; - Link route to a topic ID in the main group\n"
+    "/delete_route &lt;name&gt; - Delete a route\n\n"
+    "<b>Monitoring:</b>\n"
+    "/list_pending_orders - List all pending orders\n"
+)
+
+async def admin_start(message: Message):
     """Handles /start and /admin commands for the main bot's admin panel."""
-    if not await IsMainBot()(bot):
-        return # Ensure this handler only responds to the main bot's token
-
-    text = (
-        "<b>Admin Panel</b>\n\n"
-        "<b>Clone Bots:</b>\n"
-        "/add_clone_bot &lt;token&gt; &lt;name&gt; - Add a new clone bot token\n"
-        "/list_clone_bots - List all registered clone bots\n"
-        "/delete_clone_bot &lt;token&gt; - Delete a clone bot\n\n"
-        "<b>Routes:</b>\n"
-        "/add_route &lt;name&gt; - Add a new route (e.g., CityA-CityB)\n"
-        "/list_routes - List all routes\n"
-        "/link_route &lt;name&gt; &lt;thread_id&gt; - Link route to a topic ID in the main group\n"
-        "/delete_route &lt;name&gt; - Delete a route\n\n"
-        "<b>Monitoring:</b>\n"
-        "/list_pending_orders - List all pending orders\n"
-    )
-    await message.answer(text, parse_mode=ParseMode.HTML)
+    await message.answer(_ADMIN_HELP_HTML, parse_mode=ParseMode.HTML)
 
-async def add_clone_bot(message: Message, bot: Bot, storage: InMemoryStorage):
+async def add_clone_bot(message: Message, storage: InMemoryStorage):
     """Admin command to add a new clone bot token."""
-    if not await IsMainBot()(bot): return
     args = message.text.split(maxsplit=2)
     if len(args) != 3:
         await message.answer("Usage: /add_clone_bot <token> <name>")
@@ -202,9 +274,8 @@ async def add_clone_bot(message: Message, bot: Bot, storage: InMemoryStorage):
     storage.add_bot_instance(BotInstance(token=token, name=name, is_main=False, active=True))
     await message.answer(f"Clone bot '{name}' added successfully. <b>You need to restart the `taxi_bot.py` script for it to become active.</b>", parse_mode=ParseMode.HTML)
 
-async def list_clone_bots(message: Message, bot: Bot, storage: InMemoryStorage):
+async def list_clone_bots(message: Message, storage: InMemoryStorage):
     """Admin command to list all registered clone bots."""
-    if not await IsMainBot()(bot): return
     bots = [b for b in storage.get_all_bot_instances() if not b.is_main]
     if not bots:
         await message.answer("No clone bots registered.")
@@ -214,9 +285,8 @@ async def list_clone_bots(message: Message, bot: Bot, storage: InMemoryStorage):
         text += f"- <code>{b.token[:5]}...</code> | <b>{b.name}</b> (Active: {b.active})\n"
     await message.answer(text, parse_mode=ParseMode.HTML)
 
-async def delete_clone_bot(message: Message, bot: Bot, storage: InMemoryStorage):
+async def delete_clone_bot(message: Message, storage: InMemoryStorage):
     """Admin command to delete a clone bot by its token."""
-    if not await IsMainBot()(bot): return
     args = message.text.split(maxsplit=1)
     if len(args) != 2:
         await message.answer("Usage: /delete_clone_bot <token>")
@@ -228,23 +298,26 @@ async def delete_clone_bot(message: Message, bot: Bot, storage: InMemoryStorage)
     storage.delete_bot_instance(token)
     await message.answer(f"Clone bot with token '{token}' deleted. <b>You need to restart the `taxi_bot.py` script for it to be fully deactivated.</b>", parse_mode=ParseMode.HTML)
 
-async def add_route(message: Message, bot: Bot, storage: InMemoryStorage):
+async def add_route(message: Message, storage: InMemoryStorage):
     """Admin command to add a new route."""
-    if not await IsMainBot()(bot): return
     args = message.text.split(maxsplit=1)
     if len(args) != 2:
         await message.answer("Usage: /add_route <name>")
         return
     name = args[1].strip()
-    if storage.get_route(name):
+    key = parse_route_name(name)
+    if not key:
+        await message.answer("Route name must be '&lt;from&gt; → &lt;to&gt;', '&lt;from&gt; -&gt; &lt;to&gt;' or '&lt;from&gt;-&lt;to&gt;' (e.g., CityA-CityB).\n"
+                             "If a city name contains '-', use '→' or '-&gt;' (e.g., Ust-Kamenogorsk -&gt; Almaty).")
+        return
+    if storage.get_route(key):
         await message.answer(f"Route '{name}' already exists.")
         return
-    storage.add_route(Route(name=name))
+    storage.add_route(key, Route(name=name))
     await message.answer(f"Route '{name}' added successfully.")
 
-async def list_routes(message: Message, bot: Bot, storage: InMemoryStorage):
+async def list_routes(message: Message, storage: InMemoryStorage):
     """Admin command to list all registered routes."""
-    if not await IsMainBot()(bot): return
     routes = storage.get_all_routes()
     if not routes:
         await message.answer("No routes registered.")
@@ -255,46 +328,47 @@ async def list_routes(message: Message, bot: Bot, storage: InMemoryStorage):
         text += f"- <b>{r.name}</b>{thread_info}\n"
     await message.answer(text, parse_mode=ParseMode.HTML)
 
-async def link_route(message: Message, bot: Bot, storage: InMemoryStorage):
+async def link_route(message: Message, storage: InMemoryStorage):
     """Admin command to link a route to a Telegram group topic ID."""
-    if not await IsMainBot()(bot): return
-    args = message.text.split(maxsplit=2)
-    if len(args) != 3:
+    args = message.text.split(maxsplit=1)
+    # The thread_id is the last word, so route names may contain spaces (e.g., 'CityA → CityB')
+    args = args[1].rsplit(maxsplit=1) if len(args) == 2 else []
+    if len(args) != 2:
         await message.answer("Usage: /link_route <name> <thread_id>\n"
                              "Get thread_id by creating a topic in your main group, copying its link, and extracting the ID.")
         return
-    name = args[1].strip()
+    name = args[0].strip()
     try:
-        thread_id = int(args[2])
+        thread_id = int(args[1])
     except ValueError:
         await message.answer("Invalid thread_id. Must be an integer.")
         return
 
-    route = storage.get_route(name)
+    key = parse_route_name(name)
+    route = storage.get_route(key) if key else None
     if not route:
         await message.answer(f"Route '{name}' not found. Please add it first using /add_route.")
         return
     route.thread_id = thread_id
-    storage.add_route(route) # Use add_route to update existing entry
+    storage.add_route(key, route) # Use add_route to update existing entry
     await message.answer(f"Route '{name}' linked to topic ID <code>{thread_id}</code> successfully.", parse_mode=ParseMode.HTML)
 
-async def delete_route(message: Message, bot: Bot, storage: InMemoryStorage):
+async def delete_route(message: Message, storage: InMemoryStorage):
     """Admin command to delete a route by its name."""
-    if not await IsMainBot()(bot): return
     args = message.text.split(maxsplit=1)
     if len(args) != 2:
         await message.answer("Usage: /delete_route <name>")
         return
     name = args[1].strip()
-    if not storage.get_route(name):
+    key = parse_route_name(name)
+    if not key or not storage.get_route(key):
         await message.answer(f"Route '{name}' not found.")
         return
-    storage.delete_route(name)
+    storage.delete_route(key)
     await message.answer(f"Route '{name}' deleted.")
 
-async def list_pending_orders(message: Message, bot: Bot, storage: InMemoryStorage):
+async def list_pending_orders(message: Message, storage: InMemoryStorage):
     """Admin command to list all currently pending orders."""
-    if not await IsMainBot()(bot): return
     orders = storage.get_pending_orders()
     if not orders:
         await message.answer("No pending orders.")
@@ -304,7 +378,7 @@ async def list_pending_orders(message: Message, bot: Bot, storage: InMemoryStora
         clone_bot_info = storage.get_bot_instance(order.clone_bot_token)
         clone_bot_name = clone_bot_info.name if clone_bot_info else 'Unknown'
         text += (
-            f"ID: <code>{order.id[:8]}...</code>\n"
+            f"ID: <code>{order.id}</code>\n"
             f"From: {order.from_location}\n"
             f"To: {order.to_location}\n"
             f"Phone: {order.phone}\n"
@@ -313,63 +387,149 @@ async def list_pending_orders(message: Message, bot: Bot, storage: InMemoryStora
         )
     await message.answer(text, parse_mode=ParseMode.HTML)
 
+# --- Outbound Message Queue ---
+class TelegramSender:
+    """
+    Queues outbound Bot API calls for a single bot and sends them from a few background workers.
+    Sends are throttled to Telegram's per-bot limit (~30 messages/second), so a burst of orders
+    never blocks the handlers that produced them, and one slow call doesn't hold up the rest.
+    """
+    def __init__(self, bot: Bot, rate: float = 30, period: float = 1.0, workers: int = 4, max_retries: int = 3):
+        self.bot = bot
+        self.queue: asyncio.Queue[Tuple[str, Dict[str, Any], int]] = asyncio.Queue()
+        self.limiter = AsyncLimiter(rate, period)
+        self.max_retries = max_retries
+        self._workers = [asyncio.create_task(self._run()) for _ in range(workers)]
+        self._retries: Set[asyncio.Task] = set()
+
+    async def enqueue(self, method: str, **kwargs: Any):
+        """Schedules a Bot API call (e.g. 'send_message') with the given keyword arguments."""
+        await self.queue.put((method, kwargs, 0))
+
+    async def close(self, timeout: float = 5.0):
+        """Waits up to `timeout` seconds for queued calls to be sent, then stops the workers and pending retries."""
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Sender stopped with %d call(s) still queued.", self.queue.qsize())
+        tasks = [*self._workers, *self._retries]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _drain(self):
+        """Returns once the queue is empty and no flood-control retry is waiting to be requeued."""
+        while True:
+            await self.queue.join()
+            if not self._retries:
+                return
+            await asyncio.wait(self._retries)
+
+    async def _run(self):
+        """Consumes the queue forever, sending one call per free slot of the rate limiter."""
+        while True:
+            method, kwargs, attempt = await self.queue.get()
+            try:
+                async with self.limiter:
+                    await getattr(self.bot, method)(**kwargs)
+            except TelegramRetryAfter as e:
+                # Flood control is also applied per chat (about 20 messages/minute in a group), which the
+                # per-bot limiter can't prevent. Requeue after the requested delay without holding this worker.
+                if attempt < self.max_retries:
+                    logger.warning("Flood control on %s (chat %s), retrying in %s s.", method, kwargs.get('chat_id'), e.retry_after)
+                    task = asyncio.create_task(self._requeue_later(e.retry_after, (method, kwargs, attempt + 1)))
+                    self._retries.add(task)
+                    task.add_done_callback(self._retries.discard)
+                else:
+                    logger.error("Failed to %s (chat %s) after %d retries: %s", method, kwargs.get('chat_id'), attempt, e)
+            except Exception as e:
+                logger.error("Failed to %s (chat %s): %s", method, kwargs.get('chat_id'), e)
+            finally:
+                self.queue.task_done()
+
+    async def _requeue_later(self, delay: float, item: Tuple[str, Dict[str, Any], int]):
+        """Puts a flood-controlled call back on the queue once Telegram's retry_after has passed."""
+        await asyncio.sleep(delay)
+        await self.queue.put(item)
+
 # --- Order Distribution & Driver Interaction ---
+# Strong references to fire-and-forget tasks so they are not garbage-collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+# Driver button callback data: "<accept|reject>_order_<16 hex chars>"
+_CB_RE = re.compile(r'^(accept|reject)_order_([0-9a-f]{16})$')
+
+# Accept/reject keyboards of pending orders, reused across sends/edits of the same order
+_markup_cache: Dict[str, InlineKeyboardMarkup] = {}
+
 def get_order_markup(order_id: str) -> InlineKeyboardMarkup:
-    """Generates the inline keyboard for drivers to accept/reject an order."""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Accept Order", callback_data=f"accept_order_{order_id}"),
-            InlineKeyboardButton(text="❌ Reject Order", callback_data=f"reject_order_{order_id}")
-        ]
-    ])
-
-async def distribute_order(main_bot: Bot, order: Order, storage: InMemoryStorage):
+    """Returns the (cached) inline keyboard for drivers to accept/reject an order."""
+    markup = _markup_cache.get(order_id)
+    if markup is None:
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="✅ Accept Order", callback_data=f"accept_order_{order_id}"),
+                InlineKeyboardButton(text="❌ Reject Order", callback_data=f"reject_order_{order_id}")
+            ]
+        ])
+        _markup_cache[order_id] = markup
+    return markup
+
+# Group message for a new order; filled in by distribute_order
+_ORDER_TEMPLATE = (
+    "<b>🚨 NEW ORDER ALERT 🚨</b>\n\n"
+    "<b>From:</b> {from_location}\n"
+    "<b>To:</b> {to_location}\n"
+    "<b>Phone:</b> <code>{phone}</code>\n"
+    "<b>Luggage:</b> {luggage}\n"
+    "<b>Time:</b> {time}\n"
+    "<b>Passengers:</b> {passengers}\n"
+    "<b>Comment:</b> {comment}\n\n"
+    "Order ID: <code>{order_id}</code>"
+)
+
+async def distribute_order(sender: TelegramSender, order: Order):
     """
     Distributes a new order to the appropriate Telegram group topic.
     This function is called by the clone bot's FSM handler after an order is confirmed.
+    The message is queued on the main bot's sender rather than sent inline.
     """
-    # Construct route name from order details for lookup
-    route_name_from_order = f"{order.from_location} → {order.to_location}"
-    route = storage.get_route(route_name_from_order)
-
-    target_thread_id = None
-    if route and route.thread_id:
-        target_thread_id = route.thread_id
-        logger.info(f"Distributing order {order.id} to topic {target_thread_id} for route '{route.name}'.")
+    # The route's topic was resolved in confirm_order
+    target_thread_id = order.target_thread_id
+    if target_thread_id:
+        logger.info("Distributing order %s to topic %s.", order.id, target_thread_id)
     else:
-        logger.warning(f"No route or thread_id found for order {order.id} ({route_name_from_order}). Sending to main group without specific topic.")
+        logger.warning("No route or thread_id found for order %s (%s → %s). Sending to main group without specific topic.", order.id, order.from_location, order.to_location)
         # If no specific topic is linked, send to the general group (thread_id=None)
 
-    order_text = (
-        f"<b>🚨 NEW ORDER ALERT 🚨</b>\n\n"
-        f"<b>From:</b> {order.from_location}\n"
-        f"<b>To:</b> {order.to_location}\n"
-        f"<b>Phone:</b> <code>{order.phone}</code>\n"
-        f"<b>Luggage:</b> {order.luggage}\n"
-        f"<b>Time:</b> {order.time}\n"
-        f"<b>Passengers:</b> {order.passengers}\n"
-        f"<b>Comment:</b> {order.comment if order.comment else 'N/A'}\n\n"
-        f"Order ID: <code>{order.id[:8]}...</code>"
+    order_text = _ORDER_TEMPLATE.format(
+        from_location=order.from_location,
+        to_location=order.to_location,
+        phone=order.phone,
+        luggage=order.luggage,
+        time=order.time,
+        passengers=order.passengers,
+        comment=order.comment if order.comment else 'N/A',
+        order_id=order.id
     )
+    # Kept so driver callbacks can extend the text without re-serializing the group message
+    order.group_message_text = order_text
+
+    # Queue the order message for the main group/topic; send failures are logged by the sender.
+    await sender.enqueue(
+        "send_message",
+        chat_id=Config.MAIN_GROUP_ID,
+        text=order_text,
+        reply_markup=get_order_markup(order.id),
+        parse_mode=ParseMode.HTML,
+        message_thread_id=target_thread_id
+    )
+    logger.info("Order %s queued for group %s, topic %s.", order.id, Config.MAIN_GROUP_ID, target_thread_id)
 
-    try:
-        # Send the order message to the main group/topic
-        msg = await main_bot.send_message(
-            chat_id=Config.MAIN_GROUP_ID,
-            text=order_text,
-            reply_markup=get_order_markup(order.id),
-            parse_mode=ParseMode.HTML,
-            message_thread_id=target_thread_id
-        )
-        logger.info(f"Order {order.id} successfully posted to group {Config.MAIN_GROUP_ID}, topic {target_thread_id}.")
-    except Exception as e:
-        logger.error(f"Failed to send order {order.id} to group/topic: {e}")
-        # In a real system, you might want to notify an admin or log this failure more prominently.
-
-async def handle_order_callback(query: CallbackQuery, main_bot: Bot, storage: InMemoryStorage):
+async def handle_order_callback(query: CallbackQuery, order_match: re.Match, sender: TelegramSender, storage: InMemoryStorage):
     """Handles driver's 'Accept' or 'Reject' callback queries for orders."""
-    # Parse callback data: e.g., "accept_order_xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
-    action, order_id = query.data.split('_', 1)
+    # Callback data was already matched against _CB_RE by the handler filter, e.g. "accept_order_xxxxxxxxxxxxxxxx"
+    action, order_id = order_match.group(1), order_match.group(2)
     order = storage.get_order(order_id)
 
     if not order:
@@ -383,72 +543,71 @@ async def handle_order_callback(query: CallbackQuery, main_bot: Bot, storage: In
     driver_id = query.from_user.id
     driver_username = query.from_user.username or query.from_user.full_name
 
+    # Group/customer messages are queued first so the sender's workers deliver them while the driver is answered below
     if action == "accept":
         order.status = "accepted"
         order.driver_id = driver_id
         order.driver_username = driver_username
         storage.update_order(order)
-        await query.answer("You have accepted this order!", show_alert=True)
+        _markup_cache.pop(order_id, None) # Order is no longer pending, its keyboard won't be shown again
 
         # Edit the original message in the group topic to show it's accepted
-        try:
-            await main_bot.edit_message_text(
-                chat_id=query.message.chat.id,
-                message_id=query.message.message_id,
+        await sender.enqueue(
+            "edit_message_text",
+            chat_id=query.message.chat.id,
+            message_id=query.message.message_id,
+            text=(
+                f"{order.group_message_text or query.message.html_text}\n\n"
+                f"<b>Status: ✅ Accepted by @{driver_username}</b>"
+            ),
+            parse_mode=ParseMode.HTML,
+            reply_markup=None # Remove buttons after acceptance
+        )
+
+        # Notify the customer who placed the order
+        if order.customer_chat_id:
+            await sender.enqueue(
+                "send_message",
+                chat_id=order.customer_chat_id,
                 text=(
-                    f"{query.message.html_text}\n\n"
-                    f"<b>Status: ✅ Accepted by @{driver_username}</b>"
+                    f"🎉 Your order (ID: <code>{order.id}</code>) from <b>{order.from_location}</b> to <b>{order.to_location}</b> "
+                    f"has been <b>ACCEPTED</b> by <b>@{driver_username}</b>! "
+                    f"Driver's Telegram ID: <code>{driver_id}</code>. Please contact them via Telegram for details."
                 ),
                 parse_mode=ParseMode.HTML,
-                reply_markup=None # Remove buttons after acceptance
+                reply_to_message_id=order.customer_message_id # Reply to their original confirmation
             )
-        except Exception as e:
-            logger.error(f"Failed to edit order message {order.id} in group: {e}")
+            logger.info("Customer %s notification queued for accepted order %s.", order.customer_chat_id, order.id)
 
-        # Notify the customer who placed the order
-        if order.customer_chat_id:
-            try:
-                await main_bot.send_message(
-                    chat_id=order.customer_chat_id,
-                    text=(
-                        f"🎉 Your order (ID: <code>{order.id[:8]}...</code>) from <b>{order.from_location}</b> to <b>{order.to_location}</b> "
-                        f"has been <b>ACCEPTED</b> by <b>@{driver_username}</b>! "
-                        f"Driver's Telegram ID: <code>{driver_id}</code>. Please contact them via Telegram for details."
-                    ),
-                    parse_mode=ParseMode.HTML,
-                    reply_to_message_id=order.customer_message_id # Reply to their original confirmation
-                )
-                logger.info(f"Customer {order.customer_chat_id} notified about accepted order {order.id}.")
-            except Exception as e:
-                logger.error(f"Failed to notify customer {order.customer_chat_id} about accepted order {order.id}: {e}")
+        answer_text = "You have accepted this order!"
 
-    elif action == "reject":
+    else: # "reject"
         order.status = "rejected" # Mark as rejected by this driver, but it could still be pending for others
         storage.update_order(order)
-        await query.answer("You have rejected this order.", show_alert=True)
-
-        # Edit the original message in the group topic to show it's rejected by this driver
-        try:
-            await main_bot.edit_message_text(
-                chat_id=query.message.chat.id,
-                message_id=query.message.message_id,
-                text=(
-                    f"{query.message.html_text}\n\n"
-                    f"<b>Status: ❌ Rejected by @{driver_username}</b>"
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=None # Remove buttons after rejection by a driver
-            )
-        except Exception as e:
-            logger.error(f"Failed to edit order message {order.id} in group: {e}")
+        _markup_cache.pop(order_id, None)
+
+        # Only remove the buttons from the group message; the rejection itself is shown to the driver below
+        await sender.enqueue(
+            "edit_message_reply_markup",
+            chat_id=query.message.chat.id,
+            message_id=query.message.message_id,
+            reply_markup=None # Remove buttons after rejection by a driver
+        )
         # Customer is generally not notified on rejection, as another driver might still accept it.
 
+        answer_text = "You have rejected this order."
+
+    try:
+        await query.answer(answer_text, show_alert=True)
+    except Exception as e:
+        logger.error("Failed to answer %s callback for order %s: %s", action, order.id, e)
+
 # --- Clone Bot Handlers (Customer FSM) ---
-async def clone_bot_start(message: Message, state: FSMContext, bot: Bot):
-    """Handles /start command for clone bots, initiating the order FSM."""
-    if await IsMainBot()(bot):
-        return # Main bot's /start is handled by admin_start
+# Accepts e.g. '+1234567890', '8 (900) 123-45-67'
+_PHONE_RE = re.compile(r'^\+?\d[\d\s\-()]{6,20}$')
 
+async def clone_bot_start(message: Message, state: FSMContext):
+    """Handles /start command for clone bots, initiating the order FSM."""
     await message.answer(
         "👋 Welcome! Let's place your taxi order.\n"
         "Please tell me your <b>pickup location</b> (e.g., 'CityA, Street 123').",
@@ -476,8 +635,9 @@ async def process_to_location(message: Message, state: FSMContext):
 
 async def process_phone(message: Message, state: FSMContext):
     """Processes the phone number input."""
-    if not message.text or not message.text.strip():
-        await message.answer("Please provide a valid phone number.")
+    # Reject malformed numbers here, before the order is broadcast to drivers
+    if not message.text or not _PHONE_RE.match(message.text.strip()):
+        await message.answer("Please enter a valid phone (e.g., +1234567890).")
         return
     await state.update_data(phone=message.text.strip())
     await message.answer("Do you have any <b>luggage</b>? (e.g., 'No', 'Small bag', 'Large suitcase')", parse_mode=ParseMode.HTML)
@@ -534,11 +694,18 @@ async def process_passengers(message: Message, state: FSMContext):
     await message.answer(confirmation_text, parse_mode=ParseMode.HTML)
     await state.set_state(OrderStates.confirm_order)
 
-async def confirm_order(message: Message, state: FSMContext, main_bot: Bot, storage: InMemoryStorage, current_bot: Bot):
+async def confirm_order(message: Message, state: FSMContext, sender: TelegramSender, storage: InMemoryStorage, bot: Bot):
     """Confirms the order and initiates its distribution."""
     if message.text.lower().strip() == 'yes':
         user_data = await state.get_data()
-        order_id = str(uuid.uuid4()) # Generate a unique ID for the order
+        order_id = uuid.uuid4().hex[:16] # Short unique ID, shown to users in full
+
+        # Notify customer first so the order can be stored once, already carrying the confirmation message ID
+        customer_confirmation_msg = await message.answer(
+            "✅ Your order has been received and is being processed! We will notify you once a driver accepts it."
+        )
+
+        route = storage.get_route((user_data['from_location'], user_data['to_location']))
 
         order = Order(
             id=order_id,
@@ -549,21 +716,17 @@ async def confirm_order(message: Message, state: FSMContext, main_bot: Bot, stor
             time=user_data['time'],
             comment=user_data['comment'],
             passengers=user_data['passengers'],
-            clone_bot_token=current_bot.token, # Store which bot received the order
-            customer_chat_id=message.chat.id
+            clone_bot_token=bot.token, # Store which bot received the order
+            customer_chat_id=message.chat.id,
+            customer_message_id=customer_confirmation_msg.message_id, # For later editing/replying
+            target_thread_id=route.thread_id if route else None
         )
         storage.add_order(order)
 
-        # Notify customer that order is being processed
-        customer_confirmation_msg = await message.answer(
-            "✅ Your order has been received and is being processed! We will notify you once a driver accepts it."
-        )
-        # Update order with customer message ID for later editing/replying
-        order.customer_message_id = customer_confirmation_msg.message_id
-        storage.update_order(order) # Update the stored order with the message ID
-
-        # Distribute order to main group topics using the main_bot instance
-        await distribute_order(main_bot, order, storage)
+        # Distribute order to main group topics in the background so this chat's reply never waits on it
+        task = asyncio.create_task(distribute_order(sender, order))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
         await state.clear() # Clear FSM state after successful order
     elif message.text.lower().strip() == 'no':
@@ -573,68 +736,89 @@ async def confirm_order(message: Message, state: FSMContext, main_bot: Bot, stor
         await message.answer("Please type 'yes' or 'no'.")
 
 # --- Main Function to Run Bots ---
-async def main():
-    """Initializes and starts polling for all registered bots."""
-    storage = InMemoryStorage()
-    # Initialize the main bot instance
-    main_bot = Bot(token=Config.MAIN_BOT_TOKEN, parse_mode=ParseMode.HTML)
-    # Initialize a shared Dispatcher for all bots. MemoryStorage for FSM states.
-    dp = Dispatcher(storage=MemoryStorage())
-
-    # Pass main_bot instance and storage to handlers via workflow_data.
-    # This allows clone bot handlers to access the main_bot object for distribution.
-    dp.workflow_data.update({"main_bot": main_bot, "storage": storage})
+def create_dispatcher(main_bot: Bot, sender: TelegramSender, storage: InMemoryStorage) -> Dispatcher:
+    """Creates the Dispatcher shared by all bots and registers the admin, driver and customer handlers."""
+    # MemoryStorage for FSM states. SimpleEventIsolation locks each chat before its FSM state is loaded,
+    # so one customer's steps run in order while different chats are handled concurrently.
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=SimpleEventIsolation())
+
+    # Filter instances are shared by all registrations. Handlers rely on these filters
+    # and don't re-check the bot themselves, so each filter runs once per update.
+    # aiogram evaluates filters left to right, so the cheap bot check goes first and
+    # drops updates from the other bots before Command/regexp/admin checks run.
+    is_admin = IsAdmin(storage)
+    is_main_bot = IsMainBot(main_bot)
+    is_clone_bot = IsCloneBot(main_bot)
+
+    # Handlers get storage and sender bound at registration (functools.partial) rather than via
+    # dp.workflow_data, so they aren't copied into every update's context and looked up per call.
 
     # --- Register Admin Handlers (only for main bot token) ---
-    dp.message.register(admin_start, CommandStart(), IsAdmin(storage), IsMainBot())
-    dp.message.register(admin_start, Command("admin"), IsAdmin(storage), IsMainBot())
-    dp.message.register(add_clone_bot, Command("add_clone_bot"), IsAdmin(storage), IsMainBot())
-    dp.message.register(list_clone_bots, Command("list_clone_bots"), IsAdmin(storage), IsMainBot())
-    dp.message.register(delete_clone_bot, Command("delete_clone_bot"), IsAdmin(storage), IsMainBot())
-    dp.message.register(add_route, Command("add_route"), IsAdmin(storage), IsMainBot())
-    dp.message.register(list_routes, Command("list_routes"), IsAdmin(storage), IsMainBot())
-    dp.message.register(link_route, Command("link_route"), IsAdmin(storage), IsMainBot())
-    dp.message.register(delete_route, Command("delete_route"), IsAdmin(storage), IsMainBot())
-    dp.message.register(list_pending_orders, Command("list_pending_orders"), IsAdmin(storage), IsMainBot())
+    dp.message.register(admin_start, is_main_bot, CommandStart(), is_admin)
+    dp.message.register(admin_start, is_main_bot, Command("admin"), is_admin)
+    dp.message.register(partial(add_clone_bot, storage=storage), is_main_bot, Command("add_clone_bot"), is_admin)
+    dp.message.register(partial(list_clone_bots, storage=storage), is_main_bot, Command("list_clone_bots"), is_admin)
+    dp.message.register(partial(delete_clone_bot, storage=storage), is_main_bot, Command("delete_clone_bot"), is_admin)
+    dp.message.register(partial(add_route, storage=storage), is_main_bot, Command("add_route"), is_admin)
+    dp.message.register(partial(list_routes, storage=storage), is_main_bot, Command("list_routes"), is_admin)
+    dp.message.register(partial(link_route, storage=storage), is_main_bot, Command("link_route"), is_admin)
+    dp.message.register(partial(delete_route, storage=storage), is_main_bot, Command("delete_route"), is_admin)
+    dp.message.register(partial(list_pending_orders, storage=storage), is_main_bot, Command("list_pending_orders"), is_admin)
 
     # --- Register Order Callback Handlers (for main bot token, from group) ---
     # These handle driver interactions (accept/reject) in the main group.
-    dp.callback_query.register(handle_order_callback, F.data.startswith("accept_order_"), IsMainBot())
-    dp.callback_query.register(handle_order_callback, F.data.startswith("reject_order_"), IsMainBot())
+    # The match object is passed to the handler as `order_match`, so the data is parsed only once.
+    dp.callback_query.register(partial(handle_order_callback, sender=sender, storage=storage), is_main_bot, F.data.regexp(_CB_RE).as_("order_match"))
 
     # --- Register Clone Bot FSM Handlers (for clone bot tokens) ---
-    # These handlers are for customer interactions. They use IsCloneBot() filter.
-    dp.message.register(clone_bot_start, CommandStart(), IsCloneBot())
-    dp.message.register(process_from_location, OrderStates.waiting_for_from, IsCloneBot())
-    dp.message.register(process_to_location, OrderStates.waiting_for_to, IsCloneBot())
-    dp.message.register(process_phone, OrderStates.waiting_for_phone, IsCloneBot())
-    dp.message.register(process_luggage, OrderStates.waiting_for_luggage, IsCloneBot())
-    dp.message.register(process_time, OrderStates.waiting_for_time, IsCloneBot())
-    dp.message.register(process_comment, OrderStates.waiting_for_comment, IsCloneBot())
-    dp.message.register(process_passengers, OrderStates.waiting_for_passengers, IsCloneBot())
-    dp.message.register(confirm_order, OrderStates.confirm_order, IsCloneBot())
+    # These handlers are for customer interactions. They use the IsCloneBot filter.
+    dp.message.register(clone_bot_start, is_clone_bot, CommandStart())
+    dp.message.register(process_from_location, is_clone_bot, OrderStates.waiting_for_from)
+    dp.message.register(process_to_location, is_clone_bot, OrderStates.waiting_for_to)
+    dp.message.register(process_phone, is_clone_bot, OrderStates.waiting_for_phone)
+    dp.message.register(process_luggage, is_clone_bot, OrderStates.waiting_for_luggage)
+    dp.message.register(process_time, is_clone_bot, OrderStates.waiting_for_time)
+    dp.message.register(process_comment, is_clone_bot, OrderStates.waiting_for_comment)
+    dp.message.register(process_passengers, is_clone_bot, OrderStates.waiting_for_passengers)
+    dp.message.register(partial(confirm_order, sender=sender, storage=storage), is_clone_bot, OrderStates.confirm_order)
+    return dp
+
+async def main():
+    """Initializes and starts polling for all registered bots."""
+    storage = InMemoryStorage()
+    # One HTTP session (and so one aiohttp connection pool) shared by the main bot and all clone bots
+    session = AiohttpSession()
+    # Initialize the main bot instance
+    main_bot = Bot(token=Config.MAIN_BOT_TOKEN, session=session, parse_mode=ParseMode.HTML)
+
+    # Outbound group/customer messages go through a rate-limited queue owned by the main bot.
+    sender = TelegramSender(main_bot)
+    dp = create_dispatcher(main_bot, sender, storage)
+    # Flush queued messages before polling shuts down and closes the bot sessions
+    dp.shutdown.register(sender.close)
 
     # Prepare list of bot instances to poll concurrently
     bots_to_poll: List[Bot] = []
 
     # Add the main bot to the list
     bots_to_poll.append(main_bot)
-    logger.info(f"Main Bot '{main_bot.id}' (token: {main_bot.token[:5]}...) initialized.")
+    logger.info("Main Bot '%d' (token: %s...) initialized.", main_bot.id, main_bot.token[:5])
 
     # Dynamically initialize and add clone bots from storage
     for bot_instance in storage.get_all_bot_instances():
         if not bot_instance.is_main and bot_instance.active:
             try:
                 # Create a Bot instance for each active clone bot token
-                clone_bot = Bot(token=bot_instance.token, parse_mode=ParseMode.HTML)
+                clone_bot = Bot(token=bot_instance.token, session=session, parse_mode=ParseMode.HTML)
                 bots_to_poll.append(clone_bot)
-                logger.info(f"Clone Bot '{bot_instance.name}' (token: {clone_bot.token[:5]}...) initialized.")
+                logger.info("Clone Bot '%s' (token: %s...) initialized.", bot_instance.name, clone_bot.token[:5])
             except Exception as e:
-                logger.error(f"Failed to initialize clone bot {bot_instance.name} (token: {bot_instance.token[:5]}...): {e}")
+                logger.error("Failed to initialize clone bot %s (token: %s...): %s", bot_instance.name, bot_instance.token[:5], e)
 
-    logger.info(f"Starting polling for {len(bots_to_poll)} bot(s) concurrently...")
+    logger.info("Starting polling for %d bot(s) concurrently...", len(bots_to_poll))
     # Start polling for all bot instances. The shared Dispatcher handles routing updates.
-    await asyncio.gather(*(dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types()) for bot in bots_to_poll))
+    # start_polling must be called once with every bot: the Dispatcher refuses to run two polling loops at a time.
+    await dp.start_polling(*bots_to_poll, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,179 @@
+import asyncio
+from datetime import datetime
+from html.parser import HTMLParser
+from typing import List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import (AnswerCallbackQuery, EditMessageReplyMarkup, EditMessageText, SendMessage,
+                             TelegramMethod)
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+
+CUSTOMER_ID = 1001 # Also the customer of orders built by the make_order fixture
+DRIVER_ID = 2002
+ADMIN_ID = next(iter(main.Config.ADMIN_USER_IDS))
+
+
+# Tags Telegram accepts in HTML-formatted messages
+TELEGRAM_HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "span", "tg-spoiler",
+                      "a", "code", "pre", "tg-emoji", "blockquote"}
+
+
+class TelegramHTMLChecker(HTMLParser):
+    """Rejects tags Telegram can't parse, such as unescaped '<token>' placeholders."""
+    def handle_starttag(self, tag, attrs):
+        if tag not in TELEGRAM_HTML_TAGS:
+            raise ValueError(f"Unsupported start tag \"{tag}\"")
+
+
+class MockedSession(BaseSession):
+    """Records Bot API calls instead of sending them and answers each with a minimal successful result."""
+    def __init__(self):
+        super().__init__()
+        self.requests: List[Tuple[Bot, TelegramMethod]] = []
+
+    async def make_request(self, bot, method, timeout=None):
+        parse_mode = getattr(method, "parse_mode", None)
+        if parse_mode is not None and not isinstance(parse_mode, str):
+            parse_mode = bot.default.parse_mode # Unset on the method, so the bot's default applies
+        if parse_mode == ParseMode.HTML and getattr(method, "text", None):
+            try:
+                TelegramHTMLChecker().feed(method.text)
+            except ValueError as e:
+                raise TelegramBadRequest(method=method, message=f"Bad Request: can't parse entities: {e}")
+        self.requests.append((bot, method))
+        await asyncio.sleep(0) # Yield like a real network call would
+        if isinstance(method, SendMessage):
+            return Message(message_id=len(self.requests), date=datetime.now(),
+                           chat=Chat(id=method.chat_id, type="private"), text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def message_update(update_id: int, text: str, user_id: int = CUSTOMER_ID) -> Update:
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.now(), text=text,
+        chat=Chat(id=user_id, type="private"),
+        from_user=User(id=user_id, is_bot=False, first_name="Test"),
+    ))
+
+
+def callback_update(update_id: int, data: str) -> Update:
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id), chat_instance="group", data=data,
+        from_user=User(id=DRIVER_ID, is_bot=False, first_name="Driver", username="driver"),
+        message=Message(message_id=500, date=datetime.now(), text="order",
+                        chat=Chat(id=main.Config.MAIN_GROUP_ID, type="supergroup")),
+    ))
+
+
+class Harness:
+    """A dispatcher wired like main(), with a main and a clone bot sharing a mocked session."""
+    def __init__(self):
+        self.session = MockedSession()
+        # Same defaults as main(), so replies are checked as HTML unless they opt out
+        self.main_bot = Bot(token="42:MAIN", session=self.session, parse_mode=ParseMode.HTML)
+        self.clone_bot = Bot(token="43:CLONE", session=self.session, parse_mode=ParseMode.HTML)
+        self.storage = main.InMemoryStorage()
+        self.sender = main.TelegramSender(self.main_bot)
+        self.dp = main.create_dispatcher(self.main_bot, self.sender, self.storage)
+
+    def sent(self, bot: Bot) -> List[TelegramMethod]:
+        return [method for b, method in self.session.requests if b is bot]
+
+    async def state(self, bot: Bot, user_id: int = CUSTOMER_ID):
+        context = self.dp.fsm.get_context(bot=bot, chat_id=user_id, user_id=user_id)
+        return await context.get_state(), await context.get_data()
+
+    async def close(self):
+        await self.sender.close()
+
+
+def run(scenario):
+    async def wrapper():
+        harness = Harness()
+        try:
+            await scenario(harness)
+        finally:
+            await harness.close()
+    asyncio.run(wrapper())
+
+
+def test_clone_bot_start_begins_order():
+    async def scenario(h: Harness):
+        await h.dp.feed_update(h.clone_bot, message_update(1, "/start"))
+        replies = h.sent(h.clone_bot)
+        assert len(replies) == 1 and "pickup location" in replies[0].text
+        state, _ = await h.state(h.clone_bot)
+        assert state == main.OrderStates.waiting_for_from.state
+    run(scenario)
+
+
+def test_quick_messages_in_one_chat_advance_fsm_in_order():
+    async def scenario(h: Harness):
+        await h.dp.feed_update(h.clone_bot, message_update(1, "/start"))
+        await asyncio.gather(
+            h.dp.feed_update(h.clone_bot, message_update(2, "CityA")),
+            h.dp.feed_update(h.clone_bot, message_update(3, "CityB")),
+        )
+        state, data = await h.state(h.clone_bot)
+        assert state == main.OrderStates.waiting_for_phone.state
+        assert data == {"from_location": "CityA", "to_location": "CityB"}
+    run(scenario)
+
+
+def test_admin_panel_only_on_main_bot_for_admins():
+    async def scenario(h: Harness):
+        await h.dp.feed_update(h.main_bot, message_update(1, "/admin", user_id=ADMIN_ID))
+        assert [m.text for m in h.sent(h.main_bot)] == [main._ADMIN_HELP_HTML]
+
+        await h.dp.feed_update(h.main_bot, message_update(2, "/admin", user_id=CUSTOMER_ID))
+        await h.dp.feed_update(h.clone_bot, message_update(3, "/admin", user_id=ADMIN_ID))
+        assert len(h.sent(h.main_bot)) == 1
+        assert h.sent(h.clone_bot) == []
+    run(scenario)
+
+
+def test_driver_accepts_order(make_order):
+    async def scenario(h: Harness):
+        order = make_order()
+        h.storage.add_order(order)
+        await h.dp.feed_update(h.main_bot, callback_update(1, f"accept_order_{order.id}"))
+        await h.sender.queue.join()
+
+        assert order.status == "accepted" and order.driver_id == DRIVER_ID
+        sent = {type(m): m for m in h.sent(h.main_bot)}
+        assert set(sent) == {AnswerCallbackQuery, EditMessageText, SendMessage}
+        assert "Accepted by @driver" in sent[EditMessageText].text
+        assert sent[SendMessage].chat_id == CUSTOMER_ID
+    run(scenario)
+
+
+def test_driver_rejects_order(make_order):
+    async def scenario(h: Harness):
+        order = make_order()
+        h.storage.add_order(order)
+        await h.dp.feed_update(h.main_bot, callback_update(1, f"reject_order_{order.id}"))
+        await h.sender.queue.join()
+
+        assert order.status == "rejected"
+        assert {type(m) for m in h.sent(h.main_bot)} == {AnswerCallbackQuery, EditMessageReplyMarkup}
+    run(scenario)
+
+
+def test_add_route_rejects_ambiguous_name_with_reply():
+    async def scenario(h: Harness):
+        await h.dp.feed_update(h.main_bot, message_update(1, "/add_route Ust-Kamenogorsk-Almaty", user_id=ADMIN_ID))
+        replies = h.sent(h.main_bot)
+        assert len(replies) == 1 and "Route name must be" in replies[0].text
+        assert h.storage.get_all_routes() == ()
+    run(scenario)
@@ -0,0 +1,25 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("name, key", [
+    ("CityA → CityB", ("CityA", "CityB")),
+    ("CityA-CityB", ("CityA", "CityB")),
+    ("CityA -> CityB", ("CityA", "CityB")),
+    ("Ust-Kamenogorsk -> Almaty", ("Ust-Kamenogorsk", "Almaty")),
+    ("Naro-Fominsk → Moscow", ("Naro-Fominsk", "Moscow")),
+])
+def test_parse_route_name(name, key):
+    assert main.parse_route_name(name) == key
+
+
+@pytest.mark.parametrize("name", [
+    "CityA",
+    "-CityB",
+    "CityA →",
+    "Ust-Kamenogorsk-Almaty",
+    "Naro-Fominsk - Moscow",
+])
+def test_parse_route_name_rejects_ambiguous_or_incomplete(name):
+    assert main.parse_route_name(name) is None
@@ -0,0 +1,57 @@
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+
+
+class FakeBot:
+    """Stands in for aiogram's Bot: records send_message calls and can fail or stall selected ones."""
+    def __init__(self, flood_first: int = 0):
+        self.flood_first = flood_first
+        self.sent = []
+        self.release = asyncio.Event()
+
+    async def send_message(self, chat_id, text):
+        if text == "slow":
+            await self.release.wait()
+        if self.flood_first:
+            self.flood_first -= 1
+            raise TelegramRetryAfter(method=SendMessage(chat_id=chat_id, text=text), message="Too Many Requests", retry_after=0)
+        self.sent.append(text)
+
+
+def test_flood_control_is_retried():
+    async def scenario():
+        bot = FakeBot(flood_first=2)
+        sender = main.TelegramSender(bot)
+        await sender.enqueue("send_message", chat_id=1, text="order")
+        await sender.close()
+        assert bot.sent == ["order"]
+    asyncio.run(scenario())
+
+
+def test_flood_control_gives_up_after_max_retries():
+    async def scenario():
+        bot = FakeBot(flood_first=10)
+        sender = main.TelegramSender(bot, max_retries=2)
+        await sender.enqueue("send_message", chat_id=1, text="order")
+        await sender.close()
+        assert bot.sent == [] and bot.flood_first == 7
+    asyncio.run(scenario())
+
+
+def test_slow_call_does_not_block_queue():
+    async def scenario():
+        bot = FakeBot()
+        sender = main.TelegramSender(bot, workers=2)
+        await sender.enqueue("send_message", chat_id=1, text="slow")
+        await sender.enqueue("send_message", chat_id=2, text="fast")
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert bot.sent == ["fast"]
+        bot.release.set()
+        await sender.close()
+        assert bot.sent == ["fast", "slow"]
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import logging
+
+import main
+
+
+def test_pending_orders_keep_creation_order(make_order):
+    storage = main.InMemoryStorage()
+    for order_id in ["c", "a", "d", "b"]:
+        storage.add_order(make_order(order_id))
+
+    order = storage.get_order("a")
+    order.status = "accepted"
+    storage.update_order(order)
+    storage.update_order(storage.get_order("d"))
+
+    assert [o.id for o in storage.get_pending_orders()] == ["c", "d", "b"]
+
+
+def finish(storage: main.InMemoryStorage, order_id: str):
+    order = storage.get_order(order_id)
+    order.status = "accepted"
+    storage.update_order(order)
+
+
+def test_finished_orders_are_pruned_over_cap(monkeypatch, caplog, make_order):
+    monkeypatch.setattr(main.Config, "MAX_STORED_ORDERS", 3)
+    caplog.set_level(logging.INFO, logger=main.logger.name)
+    storage = main.InMemoryStorage()
+    for order_id in ["1", "2", "3"]:
+        storage.add_order(make_order(order_id))
+
+    caplog.clear()
+    finish(storage, "1")
+    assert list(storage.orders) == ["2", "3", "1"]
+    assert "Pruned" not in caplog.text
+
+    storage.add_order(make_order("4"))
+    storage.add_order(make_order("5"))
+    finish(storage, "2")
+    # Only finished orders are evicted, oldest first; pending ones stay even above the cap
+    assert list(storage.orders) == ["3", "4", "5"]
+    assert "Pruned 2 finished order(s)" in caplog.text
+
+
+def test_prune_skips_scan_when_only_pending_orders_remain(monkeypatch, make_order):
+    monkeypatch.setattr(main.Config, "MAX_STORED_ORDERS", 2)
+    storage = main.InMemoryStorage()
+    for order_id in ["1", "2", "3"]:
+        storage.add_order(make_order(order_id))
+
+    class NoScanDict(type(storage.orders)):
+        def __iter__(self):
+            raise AssertionError("orders scanned with nothing to evict")
+
+    # Over the cap, but every stored order is pending
+    storage.orders = NoScanDict(storage.orders)
+    storage._prune_orders()
+    assert len(storage.orders) == 3